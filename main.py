@@ -1,13 +1,22 @@
 import os
-import requests
-import time
-import json
-from typing import Optional, Dict, Any, List
-from fastapi import FastAPI, HTTPException, Depends, Header, status
+import asyncio
+import hashlib
+import hmac
+import httpx
+import orjson
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response, status
 from fastapi.security import APIKeyHeader
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from fastapi_cache.coder import Coder
+from fastapi_cache.decorator import cache
+from redis import asyncio as aioredis
 
 # Load environment variables
 load_dotenv()
@@ -16,9 +25,14 @@ load_dotenv()
 SELRO_KEY = os.getenv("SELRO_KEY")
 SELRO_SECRET = os.getenv("SELRO_SECRET")
 API_AUTH_TOKEN = os.getenv("API_AUTH_TOKEN")  # Custom token for this API
+SELRO_API_URL = "https://api.selro.com"
+# Upstream call rate per worker, matching the old one-request-per-second pacing
+SELRO_REQUESTS_PER_SECOND = float(os.getenv("SELRO_REQUESTS_PER_SECOND", "1"))
 
-# Initialize FastAPI
-app = FastAPI(title="Selro Orders API", description="API to fetch all Selro orders")
+# Response cache configuration
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+CACHE_TTL = int(os.getenv("CACHE_TTL", "60"))  # Seconds; 0 disables Redis caching
+LOCAL_CACHE_TTL = int(os.getenv("LOCAL_CACHE_TTL", "30"))  # Seconds
 
 # API key security scheme
 api_key_header = APIKeyHeader(name="Authorization", auto_error=True)
@@ -35,10 +49,10 @@ class SelroOrder(BaseModel):
     # Add other fields as needed
 
 
+# Shape of the cleaned response body: clean_json drops the envelope's null
+# message and order, and drops orders too when there are none
 class SelroOrderResponse(BaseModel):
-    orders: List[Dict[str, Any]]
-    message: Optional[str] = None
-    order: Optional[Dict[str, Any]] = None
+    orders: Optional[List[Dict[str, Any]]] = None
 
 
 # Function to recursively clean JSON data by removing null values and empty objects/arrays
@@ -49,28 +63,59 @@ def clean_json(data):
 
         # Process each key-value pair in the dictionary
         for key, value in data.items():
-            # Clean the value recursively
-            cleaned_value = clean_json(value)
+            # Skip null values
+            if value is None:
+                continue
 
-            # Only add non-null, non-empty values to the result
-            if (
-                cleaned_value is not None
-                and cleaned_value != {}
-                and cleaned_value != []
-            ):
-                result[key] = cleaned_value
+            # Clean nested containers, dropping them if nothing is left
+            if isinstance(value, (dict, list)):
+                value = clean_json(value)
+                if not value:
+                    continue
+
+            result[key] = value
 
         return result
     elif isinstance(data, list):
-        # Filter out None values and empty dictionaries/lists from the list
-        cleaned_list = [clean_json(item) for item in data if item is not None]
-        cleaned_list = [item for item in cleaned_list if item != {} and item != []]
-        return cleaned_list
+        # Filter out None values and empty dictionaries/lists in a single pass
+        result = []
+
+        for item in data:
+            if item is None:
+                continue
+
+            if isinstance(item, (dict, list)):
+                item = clean_json(item)
+                if not item:
+                    continue
+
+            result.append(item)
+
+        return result
     else:
         # Return the value as is if it's not a dictionary or list
         return data
 
 
+# Cache coder for values that are already serialized response bodies
+class BytesCoder(Coder):
+    @classmethod
+    def encode(cls, value: bytes) -> bytes:
+        return value
+
+    @classmethod
+    def decode(cls, value: bytes) -> bytes:
+        return value
+
+
+# Cache keys are namespaced by the Selro account so accounts never share entries
+def orders_key_builder(func, namespace: str = "", **kwargs) -> str:
+    selro_client = kwargs["kwargs"]["selro_client"]
+    account = hashlib.sha256(selro_client.key.encode()).hexdigest()[:16]
+    status = kwargs["kwargs"]["status"]
+    return f"{FastAPICache.get_prefix()}:{namespace}:{account}:{status}"
+
+
 # Authentication dependency
 async def verify_api_key(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
@@ -79,83 +124,315 @@ async def verify_api_key(authorization: str = Header(...)):
             detail="Invalid authorization header format",
         )
 
-    token = authorization.replace("Bearer ", "")
-    if token != API_AUTH_TOKEN:
+    # Strip only the scheme prefix and compare in constant time
+    token = authorization[len("Bearer ") :]
+    if not API_AUTH_TOKEN or not hmac.compare_digest(
+        token.encode(), API_AUTH_TOKEN.encode()
+    ):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key"
         )
     return token
 
 
+# Upstream status codes worth retrying
+RETRY_STATUS_CODES = {502, 503, 504}
+
+
+# Spaces out upstream calls so concurrent page fetches respect Selro's rate limits
+class RateLimiter:
+    def __init__(self, requests_per_second: float, max_concurrency: int):
+        self.interval = 1 / requests_per_second
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._next_slot = 0.0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        # Reserve the next free start slot; no await between read and update
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        try:
+            await asyncio.sleep(slot - now)
+        except BaseException:
+            # __aexit__ never runs if we are cancelled here, so return the permit
+            self.semaphore.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
 # Selro API client
 class SelroClient:
-    def __init__(self, key: str, secret: str):
+    def __init__(
+        self,
+        key: str,
+        secret: str,
+        client: httpx.AsyncClient,
+        page_window: int = 5,
+        requests_per_second: float = 1,
+        max_retries: int = 3,
+        backoff_factor: float = 0.3,
+    ):
         self.key = key
         self.secret = secret
-        self.base_url = "https://api.selro.com/8/orders"
+        self.page_size = 100
+        # Orders URL carrying the query parameters shared by every page request
+        self._orders_url = httpx.URL(
+            f"{SELRO_API_URL}/8/orders",
+            params={"key": key, "secret": secret, "pagesize": self.page_size},
+        )
+        # Number of pages requested concurrently per batch
+        self.page_window = page_window
+        self.rate_limiter = RateLimiter(requests_per_second, page_window)
+        # Retries for transient gateway errors, with exponential backoff
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # Shared connection pool, closed with aclose() on app shutdown
+        self.client = client
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _fetch_page(self, url: httpx.URL, page: int) -> List[Dict[str, Any]]:
+        """
+        Fetch a single page of orders, returning an empty list when there are none
+        """
+        page_url = url.copy_merge_params({"page": page})
 
-    def fetch_all_orders(self, status: str, max_pages: int = 100) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            async with self.rate_limiter:
+                response = await self.client.get(page_url)
+
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.max_retries
+            ):
+                break
+            await asyncio.sleep(self.backoff_factor * 2**attempt)
+        response.raise_for_status()
+
+        data = orjson.loads(response.content)
+        if not data:
+            return []
+        return data.get("orders") or []
+
+    async def fetch_all_orders(
+        self, order_status: str, max_pages: int = 100
+    ) -> Dict[str, Any]:
         """
-        Fetch all orders with the specified status, handling pagination
+        Fetch all orders with the specified status, handling pagination.
+        The first page is fetched alone; if it is full, the rest are requested
+        in concurrent batches of `page_window`.
         """
         page = 1
-        page_size = 100
+        page_size = self.page_size
         all_orders = []
         has_more_orders = True
+        # Most statuses fit on one page, so don't fan out until page 1 is full
+        batch_size = 1
+        # Only the page number changes between requests for this status
+        url = self._orders_url.copy_merge_params({"status": order_status})
 
         while has_more_orders and page <= max_pages:
-            url = f"{self.base_url}?key={self.key}&secret={self.secret}&page={page}&pagesize={page_size}&status={status}"
+            batch = range(page, min(page + batch_size, max_pages + 1))
 
             try:
-                response = requests.get(url)
-                response.raise_for_status()
-
-                data = response.json()
-
-                if data and "orders" in data and len(data["orders"]) > 0:
-                    orders = data["orders"]
-                    all_orders.extend(orders)
-
-                    # Check if we need to fetch more pages
-                    if len(orders) < page_size:
-                        has_more_orders = False
-                    else:
-                        page += 1
-                        # Add a small delay to prevent API rate limiting
-                        time.sleep(1)
+                pages = await asyncio.gather(*(self._fetch_page(url, p) for p in batch))
+            except httpx.HTTPError as e:
+                # Log the error without its message, which includes the request
+                # URL and so the Selro key and secret
+                if isinstance(e, httpx.HTTPStatusError):
+                    reason = f"HTTP {e.response.status_code}"
                 else:
-                    has_more_orders = False
-
-            except requests.exceptions.RequestException as e:
-                # Log the error
-                print(f"Error fetching data from Selro API: {e}")
+                    reason = type(e).__name__
+                print(f"Error fetching data from Selro API: {reason}")
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Error communicating with Selro API: {str(e)}",
+                    detail=f"Error communicating with Selro API: {reason}",
                 )
 
-        # Clean the response by removing null values and empty objects
-        cleaned_orders = clean_json(all_orders)
-        return {"orders": cleaned_orders, "message": None, "order": None}
+            for orders in pages:
+                all_orders.extend(orders)
 
+                # A short page is the last one; ignore anything fetched past it
+                if len(orders) < page_size:
+                    has_more_orders = False
+                    break
+
+            page += len(batch)
+            batch_size = self.page_window
+
+        return {"orders": all_orders, "message": None, "order": None}
+
+
+# Validate configuration and open shared connections once per worker
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fail fast rather than sending key=None&secret=None upstream; covers
+    # `uvicorn main:app` launches, which skip the __main__ check
+    if not SELRO_KEY or not SELRO_SECRET or not API_AUTH_TOKEN:
+        raise RuntimeError(
+            "Missing required environment variables. Please set SELRO_KEY, SELRO_SECRET, and API_AUTH_TOKEN."
+        )
 
-# Create Selro client
-selro_client = SelroClient(SELRO_KEY, SELRO_SECRET)
+    # Short timeouts so an unreachable Redis falls through to Selro instead of
+    # stalling requests until the OS TCP timeout
+    redis = aioredis.from_url(REDIS_URL, socket_connect_timeout=1, socket_timeout=1)
+    # fastapi-cache2 treats expire=0 as "use the default", which is no expiry,
+    # so a TTL of 0 has to switch the Redis tier off instead
+    FastAPICache.init(
+        RedisBackend(redis),
+        prefix="selro",
+        coder=BytesCoder,
+        enable=CACHE_TTL > 0,
+    )
+
+    # Keep-alive pool reused across pages and requests; the transport also
+    # retries failed connection attempts
+    transport = httpx.AsyncHTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    )
+    client = httpx.AsyncClient(base_url=SELRO_API_URL, timeout=30, transport=transport)
+    app.state.selro = SelroClient(
+        SELRO_KEY,
+        SELRO_SECRET,
+        client,
+        requests_per_second=SELRO_REQUESTS_PER_SECOND,
+    )
+
+    yield
+
+    await app.state.selro.aclose()
+    await redis.close()
 
 
-# Custom response class to handle JSON cleanup
-@app.get("/api/orders/unshipped")
-async def get_unshipped_orders(api_key: str = Depends(verify_api_key)):
+# Initialize FastAPI
+app = FastAPI(
+    title="Selro Orders API",
+    description="API to fetch all Selro orders",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+
+
+# Selro client dependency
+def get_selro_client(request: Request) -> SelroClient:
+    return request.app.state.selro
+
+
+@cache(expire=CACHE_TTL, namespace="orders", key_builder=orders_key_builder)
+async def fetch_orders_cached(selro_client: SelroClient, status: str) -> bytes:
     """
-    Get all unshipped orders from Selro with cleaned output (no null values)
+    Fetch orders with the specified status as a serialized response body,
+    served from Redis while fresh
     """
-    try:
-        result = selro_client.fetch_all_orders(status="Unshipped")
+    result = await selro_client.fetch_all_orders(order_status=status)
 
-        # Remove message and order from the response if they are None
-        cleaned_result = clean_json(result)
+    # Clean once before caching by removing null values and empty objects,
+    # then serialize so Redis hits need no decoding or re-encoding.
+    # Serializing up front also lets the payload skip jsonable_encoder entirely
+    return orjson.dumps(clean_json(result))
 
-        return JSONResponse(content=cleaned_result)
+
+# In-process cache of serialized responses, checked before Redis
+response_cache = TTLCache(maxsize=8, ttl=LOCAL_CACHE_TTL)
+# Fetches currently refilling the in-process cache, keyed by status
+inflight_fetches: Dict[str, asyncio.Task] = {}
+
+
+async def refill_orders_body(
+    selro_client: SelroClient, status: str
+) -> Tuple[bytes, str]:
+    """
+    Load the serialized orders response for a status from Redis or Selro
+    and store it, with its ETag, in the in-process cache
+    """
+    body = await fetch_orders_cached(selro_client=selro_client, status=status)
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    cached = response_cache[status] = (body, etag)
+    return cached
+
+
+async def get_orders_body(selro_client: SelroClient, status: str) -> Tuple[bytes, str]:
+    """
+    Get the serialized orders response and its ETag for a status, refilling
+    the in-process cache from Redis or Selro when it has expired
+    """
+    cached = response_cache.get(status)
+    if cached is not None:
+        return cached
+
+    # Concurrent misses for the same status share a single fetch. It runs in
+    # its own task so no requester's cancellation can cancel it for the others
+    task = inflight_fetches.get(status)
+    if task is None:
+        task = asyncio.create_task(refill_orders_body(selro_client, status))
+        inflight_fetches[status] = task
+
+        def clear_inflight(done: asyncio.Task):
+            if inflight_fetches.get(status) is done:
+                del inflight_fetches[status]
+            # Mark a failure as retrieved even if every requester has gone
+            if not done.cancelled():
+                done.exception()
+
+        task.add_done_callback(clear_inflight)
+
+    # Shield so a disconnecting requester does not cancel the shared fetch
+    return await asyncio.shield(task)
+
+
+# Whether the client already holds the representation identified by etag.
+# If-None-Match uses weak comparison, so a W/ prefix (added by proxies that
+# re-encode the body) is ignored
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+# Response models are documentation only; the body is returned pre-serialized
+@app.get(
+    "/api/orders/unshipped",
+    responses={
+        200: {"model": SelroOrderResponse},
+        304: {"description": "Orders unchanged since the supplied ETag"},
+    },
+)
+async def get_unshipped_orders(
+    request: Request,
+    api_key: str = Depends(verify_api_key),
+    selro_client: SelroClient = Depends(get_selro_client),
+):
+    """
+    Get all unshipped orders from Selro with cleaned output (no null values)
+    """
+    try:
+        body, etag = await get_orders_body(selro_client, status="Unshipped")
+
+        # Send the same caching headers either way so a 304 renews freshness
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"private, max-age={LOCAL_CACHE_TTL}",
+        }
+
+        # Skip sending the body when the client's copy is still current
+        if etag_matches(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return Response(content=body, media_type="application/json", headers=headers)
+    except HTTPException:
+        # Already describes the failure; don't wrap it again
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -163,8 +440,19 @@ async def get_unshipped_orders(api_key: str = Depends(verify_api_key)):
         )
 
 
-# @app.get("/api/orders/{status}")
-# async def get_orders_by_status(status: str, api_key: str = Depends(verify_api_key)):
+# @app.get(
+#     "/api/orders/{status}",
+#     responses={
+#         200: {"model": SelroOrderResponse},
+#         304: {"description": "Orders unchanged since the supplied ETag"},
+#     },
+# )
+# async def get_orders_by_status(
+#     request: Request,
+#     status: str,
+#     api_key: str = Depends(verify_api_key),
+#     selro_client: SelroClient = Depends(get_selro_client),
+# ):
 #     """
 #     Get all orders with a specific status from Selro with cleaned output (no null values)
 #     """
@@ -184,12 +472,16 @@ async def get_unshipped_orders(api_key: str = Depends(verify_api_key)):
 #         )
 
 #     try:
-#         result = selro_client.fetch_all_orders(status=status)
+#         body, etag = await get_orders_body(selro_client, status=status)
+
+#         headers = {"ETag": etag, "Cache-Control": f"private, max-age={LOCAL_CACHE_TTL}"}
 
-#         # Remove message and order from the response if they are None
-#         cleaned_result = clean_json(result)
+#         if etag_matches(request, etag):
+#             return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-#         return JSONResponse(content=cleaned_result)
+#         return Response(content=body, media_type="application/json", headers=headers)
+#     except HTTPException:
+#         raise
 #     except Exception as e:
 #         raise HTTPException(
 #             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -203,13 +495,25 @@ if __name__ == "__main__":
     # Load configurations from environment or use defaults
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
+    workers = int(os.getenv("WORKERS", "2"))
+    reload = os.getenv("RELOAD", "false").lower() == "true"  # Development only
 
-    # Check if API credentials are set
+    # Check if API credentials are set. The lifespan check alone is not enough
+    # here: with multiple workers, uvicorn's supervisor keeps running after
+    # every worker has failed startup
     if not SELRO_KEY or not SELRO_SECRET or not API_AUTH_TOKEN:
         print(
             "ERROR: Missing required environment variables. Please set SELRO_KEY, SELRO_SECRET, and API_AUTH_TOKEN."
         )
         exit(1)
 
-    # Run the FastAPI app
-    uvicorn.run("main:app", host=host, port=port, reload=True)
+    # Run the FastAPI app on uvloop with the httptools parser
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        reload=reload,
+    )